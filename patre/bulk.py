@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011 Nicolai Hähnle <nhaehnle@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Bulk tokenization of C++ source files using NumPy.
+
+Produces exactly the same token stream as patre.cpp.tokenizer, but classifies
+characters with vector operations instead of inspecting them one at a time.
+If NumPy is not available, the tokenizer silently falls back to patre.cpp.
+"""
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+import gc
+import itertools
+
+import cpp
+from text import TextRange, where_from_pos
+
+def chartable(chars):
+	table = numpy.zeros(256, dtype=bool)
+	for c in chars:
+		table[ord(c)] = True
+	return table
+
+if numpy != None:
+	LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_"
+	IDSTART = chartable(LETTERS)
+	IDCHAR = chartable(LETTERS + "0123456789")
+	WHITE = chartable(" \t\n")
+	SPECIAL = chartable("\"'/")
+
+def shifted(mask, first):
+	"""
+	Return mask shifted by one position, so that result[i] == mask[i-1], with result[0] == first.
+	"""
+	result = numpy.empty_like(mask)
+	result[0] = first
+	result[1:] = mask[:-1]
+	return result
+
+def find_regions(text, specials):
+	"""
+	Find comments and string literals, scanning only the candidate positions of their delimiters.
+
+	Returns a list of (start, end, literal) triples, and the (pos, exception) of the first error
+	that the character-based tokenizer would raise, if any.
+	"""
+	regions = []
+	skip = 0
+	for pos in specials:
+		if pos < skip:
+			continue
+
+		c = text[pos]
+		if c == '/':
+			if text.startswith('//', pos):
+				end = text.find('\n', pos + 2)
+				if end == -1:
+					end = len(text)
+				else:
+					end += 1
+			elif text.startswith('/*', pos):
+				end = text.find('*/', pos + 2)
+				if end == -1:
+					return regions, (pos, ValueError("%s: unterminated /* */ style comment" % (where_from_pos(text, pos))))
+				end += 2
+			else:
+				continue
+			regions.append((pos, end, False))
+		else:
+			end = pos + 1
+			while True:
+				end = text.find(c, end)
+				if end == -1:
+					return regions, (pos, ValueError("unterminated string literal"))
+				backslash = end
+				while text[backslash - 1] == '\\' and backslash - 1 > pos:
+					backslash -= 1
+				if (end - backslash) % 2 == 0:
+					break
+				end += 1
+			end += 1
+			regions.append((pos, end, True))
+		skip = end
+	return regions, None
+
+def tokenize(text):
+	"""
+	Return the list of tokens in text, and the (pos, exception) of a tokenization error, if any.
+	Only the tokens before the error are returned in that case.
+	"""
+	if not text:
+		return [], None
+
+	chars = numpy.frombuffer(text, dtype=numpy.uint8)
+	regions, error = find_regions(text, numpy.flatnonzero(SPECIAL[chars]).tolist())
+	if error != None:
+		chars = chars[:error[0]]
+		if not len(chars):
+			return [], error
+
+	# Characters outside of comments and literals
+	delta = numpy.zeros(len(chars) + 1, dtype=numpy.int32)
+	for start, end, literal in regions:
+		delta[start] += 1
+		delta[end] -= 1
+	plain = numpy.cumsum(delta[:-1]) == 0
+
+	# Identifiers: runs of identifier characters, minus their leading digits
+	indices = numpy.arange(len(chars))
+	idchar = IDCHAR[chars] & plain
+	runstart = numpy.maximum.accumulate(numpy.where(idchar & ~shifted(idchar, False), indices, -1))
+	laststart = numpy.maximum.accumulate(numpy.where(IDSTART[chars] & plain, indices, -1))
+	inid = idchar & (laststart >= runstart)
+	idstarts = numpy.flatnonzero(inid & ~shifted(inid, False))
+	idends = numpy.flatnonzero(inid & ~numpy.append(inid[1:], False)) + 1
+
+	# Everything else that is not whitespace is a single character token
+	singles = numpy.flatnonzero(plain & ~inid & ~WHITE[chars])
+
+	literals = [(start, end) for start, end, literal in regions if literal]
+	starts = numpy.concatenate((
+		idstarts, singles, numpy.array([start for start, end in literals], dtype=indices.dtype)
+	))
+	ends = numpy.concatenate((
+		idends, singles + 1, numpy.array([end for start, end in literals], dtype=indices.dtype)
+	))
+	kinds = numpy.concatenate((
+		numpy.zeros(len(idstarts), dtype=numpy.int8),
+		numpy.ones(len(singles), dtype=numpy.int8),
+		numpy.zeros(len(literals), dtype=numpy.int8) + 2,
+	))
+	order = numpy.argsort(starts, kind='mergesort')
+
+	# Creating all token objects at once would otherwise trigger the cyclic garbage collector
+	# over and over again, even though none of them can be part of a cycle.
+	tags = numpy.array(["id", None, "literal"], dtype=object)
+	collecting = gc.isenabled()
+	gc.disable()
+	try:
+		tokens = map(
+			TextRange, itertools.repeat(text, len(order)),
+			starts[order].tolist(), ends[order].tolist(), tags[kinds[order]].tolist()
+		)
+	finally:
+		if collecting:
+			gc.enable()
+	return tokens, error
+
+class BulkTokenizer(object):
+	"""
+	Drop-in replacement for patre.cpp.tokenizer that tokenizes whole files at once.
+
+	Tokenizing from an offset or with an override function (as done when compiling
+	expressions) is delegated to the character-based tokenizer.
+	"""
+	def __init__(self, fallback):
+		self.fallback = fallback
+
+	def __call__(self, text, pos=0, override=None):
+		if numpy == None or pos != 0 or override != None or not isinstance(text, str):
+			return self.fallback(text, pos, override)
+
+		class Instance(object):
+			def __init__(self, text):
+				self.text = text
+				self.pos = 0
+
+			def __call__(self):
+				tokens, error = tokenize(self.text)
+				for token in tokens:
+					self.pos = token.end
+					yield token
+				if error != None:
+					raise error[1]
+				self.pos = len(self.text)
+		return Instance(text)
+
+tokenizer = BulkTokenizer(cpp.tokenizer)
@@ -28,7 +28,7 @@ concise language into non-deterministic finite automata (NFA).
 
 import re
 
-from nfa import Nfa, nfa_token, nfa_tag, nfa_list, nfa_any, nfa_not
+from nfa import Nfa, nfa_token, nfa_tag, nfa_list, nfa_any, nfa_not, nfa_descend
 from text import TextError, TextRange
 
 class Options(object):
@@ -217,3 +217,320 @@ def compile(nfa, expr, options):
 	tree, end = do_compile_maketree(nfa, expr, 0, None, options)
 	endstate = do_compile_transitions(nfa, startstate, tree, options)
 	return startstate, endstate
+
+def match_reference(match):
+	"""
+	Return (nfa, startstate, endstate) for matching functions that run an NFA themselves,
+	where endstate is None if the function does not look for a particular end state.
+	"""
+	if hasattr(match, "sublist"):
+		return match.sublist
+	if hasattr(match, "negated"):
+		return match.negated
+	if hasattr(match, "descend"):
+		return match.descend + (None,)
+	return None
+
+def transition_key(transition):
+	"""
+	Return a key that is equal for transitions that behave identically (apart from
+	their end state), or None if the transition must not be merged with others.
+	"""
+	if transition.match == None:
+		if transition.callback:
+			return None
+		return ("eps", transition.priority, transition.prevcapture, transition.nextcapture, transition.stack)
+
+	match = transition.match
+	if hasattr(match, "key"):
+		return match.key + (transition.priority,)
+	if hasattr(match, "sublist"):
+		return ("list",) + match.sublist + (transition.priority,)
+	if hasattr(match, "negated"):
+		return ("not",) + match.negated + (transition.priority,)
+	return ("function", match, transition.priority)
+
+def rebuild_match(match, nfas, statemaps):
+	"""
+	Re-create a matching function that runs an NFA, so that it runs nfas[nfa] instead,
+	with the states of nfa mapped by statemaps[nfa].
+	"""
+	if hasattr(match, "sublist"):
+		nfa, startstate, endstate = match.sublist
+		return nfa_list(nfas[nfa], statemaps[nfa][startstate], statemaps[nfa][endstate])
+	if hasattr(match, "negated"):
+		nfa, startstate, endstate = match.negated
+		return nfa_not(nfas[nfa], statemaps[nfa][startstate], statemaps[nfa][endstate])
+	if hasattr(match, "descend"):
+		nfa, startstate = match.descend
+		return nfa_descend(nfas[nfa], statemaps[nfa][startstate])
+	return match
+
+def copy_nfas(nfas):
+	"""
+	Return a dictionary mapping each of the given NFAs to a copy of it, where the matching
+	functions of the copies run the copies.
+	"""
+	copies = dict((nfa, Nfa()) for nfa in nfas)
+	identity = dict((nfa, range(len(nfa.states))) for nfa in nfas)
+	for nfa in nfas:
+		copy = copies[nfa]
+		for state in nfa.states:
+			copy.newstate()
+		for state in nfa.states:
+			for t in state.transitions + state.epsilons:
+				match = t.match
+				if match != None:
+					match = rebuild_match(match, copies, identity)
+				newt = copy.transition(t.start, t.end, match)
+				newt.priority = t.priority
+				newt.callback = t.callback
+				newt.prevcapture = t.prevcapture
+				newt.nextcapture = t.nextcapture
+				newt.stack = t.stack
+	return copies
+
+class Simplifier(object):
+	"""
+	Simplify a single NFA in place, given the states at which runs can start and the
+	states that are looked for at the end of runs.
+	"""
+	def __init__(self, nfa, starts, goals):
+		self.nfa = nfa
+		self.starts = starts
+		self.goals = goals
+		self.incoming = [[] for state in nfa.states]
+		for state in nfa.states:
+			for t in state.transitions + state.epsilons:
+				self.incoming[t.end].append(t)
+
+	def outgoing(self, state):
+		return self.nfa.states[state].transitions + self.nfa.states[state].epsilons
+
+	def remove(self, t):
+		state = self.nfa.states[t.start]
+		if t.match != None:
+			state.transitions.remove(t)
+		else:
+			state.epsilons.remove(t)
+		self.incoming[t.end].remove(t)
+
+	def absorb(self, state, other):
+		"""
+		Move all outgoing transitions of other to state, and redirect transitions into other to state.
+		"""
+		for t in self.nfa.states[other].transitions:
+			t.start = state
+			self.nfa.states[state].transitions.append(t)
+		for t in self.nfa.states[other].epsilons:
+			t.start = state
+			self.nfa.states[state].epsilons.append(t)
+		self.nfa.states[other].transitions = []
+		self.nfa.states[other].epsilons = []
+		for t in self.incoming[other]:
+			t.end = state
+			self.incoming[state].append(t)
+		self.incoming[other] = []
+
+	def mergeable(self, state, origin):
+		"""
+		Whether all threads at state are copies of a thread at origin.
+		"""
+		return (state != origin and len(self.incoming[state]) == 1 and
+		        not state in self.starts and not state in self.goals)
+
+	def merge_siblings(self):
+		"""
+		Merge states that are reached from the same state by equivalent transitions, and by nothing else.
+		Threads at such states are always identical copies, and merging them shares common prefixes
+		(e.g. of rules hanging off the same start state).
+		"""
+		queue = range(len(self.nfa.states))
+		while queue:
+			state = queue.pop()
+			groups = {}
+			for t in self.outgoing(state):
+				key = transition_key(t)
+				if key != None and self.mergeable(t.end, state):
+					groups.setdefault(key, []).append(t)
+
+			for group in groups.itervalues():
+				if len(group) < 2:
+					continue
+				keep = group[0].end
+				for t in group[1:]:
+					other = t.end
+					self.remove(t)
+					self.absorb(keep, other)
+					self.replaced[other] = keep
+				queue.append(keep)
+
+	def collapse_epsilons(self):
+		"""
+		Collapse chains of plain epsilon transitions, where a state has nothing but a single
+		epsilon transition to a state that can only be reached through that transition.
+		"""
+		for state in range(len(self.nfa.states)):
+			while True:
+				if self.nfa.states[state].transitions or len(self.nfa.states[state].epsilons) != 1:
+					break
+				t = self.nfa.states[state].epsilons[0]
+				if transition_key(t) != ("eps", None, None, None, None):
+					break
+				other = t.end
+				if other == state or other in self.starts or len(self.incoming[other]) != 1:
+					break
+				self.remove(t)
+				self.absorb(state, other)
+				if other in self.goals:
+					self.goals.add(state)
+				self.replaced[other] = state
+
+	def live_states(self):
+		"""
+		Return the states that can be reached from a start state and can themselves
+		reach something of consequence: a goal state, a callback, or a matching function
+		that may have side effects.
+		"""
+		reached = set(self.starts)
+		queue = list(self.starts)
+		while queue:
+			state = queue.pop()
+			for t in self.outgoing(state):
+				if not t.end in reached:
+					reached.add(t.end)
+					queue.append(t.end)
+
+		useful = set(self.goals)
+		for state in range(len(self.nfa.states)):
+			for t in self.outgoing(state):
+				if t.callback or (t.match != None and not (
+				   hasattr(t.match, "key") or hasattr(t.match, "sublist") or hasattr(t.match, "negated"))):
+					useful.add(t.end)
+		queue = list(useful)
+		while queue:
+			state = queue.pop()
+			for t in self.incoming[state]:
+				if not t.start in useful:
+					useful.add(t.start)
+					queue.append(t.start)
+
+		return (reached & useful) | self.starts | self.goals
+
+	def run(self, merge=True):
+		"""
+		Simplify the NFA, and return a dictionary mapping old to new state numbers.
+
+		If merge is False, states are only removed if they cannot be reached or cannot lead to
+		anything of consequence, and the remaining states keep their relative order.
+		"""
+		self.replaced = {}
+		if merge:
+			self.merge_siblings()
+			self.collapse_epsilons()
+
+		live = self.live_states()
+		statemap = {}
+		for state in range(len(self.nfa.states)):
+			if state in live:
+				statemap[state] = len(statemap)
+		for old, new in self.replaced.iteritems():
+			while not new in statemap and new in self.replaced:
+				new = self.replaced[new]
+			if new in statemap:
+				statemap[old] = statemap[new]
+		return statemap
+
+def family(nfa, roots):
+	"""
+	Return the list of the given NFA and all NFAs that are run by its matching functions (directly
+	or indirectly), and dictionaries mapping each of them to the sets of states at which they are
+	started and of states that are looked for at the end of runs.
+	"""
+	nfas = [nfa]
+	starts = { nfa: set(roots) }
+	goals = { nfa: set() }
+	idx = 0
+	while idx < len(nfas):
+		for state in nfas[idx].states:
+			for t in state.transitions:
+				reference = match_reference(t.match)
+				if reference != None:
+					subnfa, startstate, endstate = reference
+					if not subnfa in starts:
+						nfas.append(subnfa)
+						starts[subnfa] = set()
+						goals[subnfa] = set()
+					starts[subnfa].add(startstate)
+					if endstate != None:
+						goals[subnfa].add(endstate)
+		idx += 1
+	return nfas, starts, goals
+
+def renumber(nfas, statemaps):
+	"""
+	Rebuild the states of the given NFAs in place according to statemaps, which map every NFA's
+	old states to new ones (several of which may be merged, and missing ones are removed).
+	"""
+	same = dict((nfa, nfa) for nfa in nfas)
+	for nfa in nfas:
+		statemap = statemaps[nfa]
+		oldstates = nfa.states
+		nfa.states = []
+		for oldidx in range(len(oldstates)):
+			if not oldidx in statemap or statemap[oldidx] != len(nfa.states):
+				continue
+			nfa.states.append(Nfa.State())
+			for t in oldstates[oldidx].transitions + oldstates[oldidx].epsilons:
+				if not t.end in statemap:
+					continue
+				t.start = statemap[t.start]
+				t.end = statemap[t.end]
+				if t.match != None:
+					t.match = rebuild_match(t.match, same, statemaps)
+					nfa.states[-1].transitions.append(t)
+				else:
+					nfa.states[-1].epsilons.append(t)
+		nfa.reset_cache()
+
+def optimize(nfa, roots):
+	"""
+	Optimize a compiled NFA in place, and build an optimized copy of it for capture-free recognition
+	(see Nfa.search). Returns a dictionary mapping the old states of the NFA to the new ones.
+
+	States that cannot be reached or cannot lead to anything of consequence are removed from the
+	NFA, and the remaining states keep their relative order, so that the order in which runs with
+	captures try threads (and with it, which of several threads reaching the same state wins) is
+	the same as before.
+
+	The copy recognizes the same matches and triggers callbacks at the same places, but is simplified
+	further: states reached by identical transitions from the same state are merged (which shares
+	common prefixes of expressions), and chains of plain epsilon transitions are collapsed. This
+	changes the order in which threads are tried, which does not matter without captures.
+
+	roots are the states at which the NFA is run from the outside. The NFAs that are run by matching
+	functions are optimized (and get copies) as well. The copy of every NFA is stored as its
+	recognizer, together with a dictionary mapping its states to the states of the copy (for all
+	states that were not removed, including those that were merged into others).
+	"""
+	nfas, starts, goals = family(nfa, roots)
+	statemaps = dict(
+		(subnfa, Simplifier(subnfa, starts[subnfa], goals[subnfa]).run(merge=False)) for subnfa in nfas
+	)
+	renumber(nfas, statemaps)
+	result = statemaps[nfa]
+
+	nfas, starts, goals = family(nfa, [result[root] for root in roots])
+	copies = copy_nfas(nfas)
+	copynfas = [copies[original] for original in nfas]
+	copystarts = dict((copies[original], states) for original, states in starts.items())
+	copygoals = dict((copies[original], states) for original, states in goals.items())
+
+	statemaps = dict(
+		(copy, Simplifier(copy, copystarts[copy], copygoals[copy]).run()) for copy in copynfas
+	)
+	renumber(copynfas, statemaps)
+
+	for original, copy in copies.items():
+		original.recognizer = (copy, statemaps[copy])
+	return result
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011 Nicolai Hähnle <nhaehnle@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+
+"""
+Format the changes recorded by a patre.text.Editor as a unified diff.
+
+Hunks are computed directly from the offsets of the changes, so that the
+unchanged parts of a file never need to be compared.
+"""
+
+import bisect
+
+NO_NEWLINE = "\\ No newline at end of file\n"
+
+def format_range(first, length):
+	"""
+	Format the line range of a hunk header, given the 0-based first line and the number of lines.
+	"""
+	if length == 1:
+		return "%d" % (first + 1)
+	if length == 0:
+		return "%d,0" % (first)
+	return "%d,%d" % (first + 1, length)
+
+def line_starts(text):
+	"""
+	Return the offsets at which the lines of text start, followed by len(text).
+	"""
+	starts = [0]
+	pos = text.find('\n')
+	while pos != -1:
+		starts.append(pos + 1)
+		pos = text.find('\n', pos + 1)
+	if starts[-1] != len(text):
+		starts.append(len(text))
+	return starts
+
+def split_lines(text):
+	"""
+	Split text into lines, keeping the line breaks.
+	"""
+	lines = [line + '\n' for line in text.split('\n')]
+	lines[-1] = lines[-1][:-1]
+	if not lines[-1]:
+		lines.pop()
+	return lines
+
+def regions(text, starts, changes):
+	"""
+	Turn the sorted (start, end, replacement) changes into a list of (first, last, new)
+	triples, each of which replaces the lines [first, last) of text by new.
+	"""
+	nlines = len(starts) - 1
+
+	def line_of(pos):
+		line = bisect.bisect_right(starts, pos) - 1
+		if line == nlines and nlines > 0 and text[-1] != '\n':
+			line -= 1
+		return line
+
+	result = []
+	idx = 0
+	while idx < len(changes):
+		first = last = line_of(changes[idx][0])
+		pieces = []
+		where = starts[first]
+		while True:
+			if idx < len(changes) and (not pieces or line_of(changes[idx][0]) < last):
+				start, end, what = changes[idx]
+				pieces.append(text[where:start])
+				pieces.append(what)
+				where = end
+				idx += 1
+
+				line = line_of(end)
+				if end > starts[line]:
+					line += 1
+				last = max(last, line)
+				continue
+
+			# The new text must end with a line break, unless it is at the end of the file
+			new = ''.join(pieces) + text[where:starts[last]]
+			if last == nlines or not new or new[-1] == '\n':
+				break
+			last += 1
+
+		if new != text[starts[first]:starts[last]]:
+			result.append((first, last, new))
+	return result
+
+def unified_diff(text, changes, oldname, newname, context=3):
+	"""
+	Return a unified diff that turns text into the result of applying the given
+	(start, end, replacement) changes, as returned by patre.text.Editor.changes().
+	"""
+	starts = line_starts(text)
+	nlines = len(starts) - 1
+	replaced = regions(text, starts, changes)
+	if not replaced:
+		return ''
+
+	def line(prefix, i):
+		out.append(prefix + text[starts[i]:starts[i+1]])
+		if i == nlines - 1 and text[-1] != '\n':
+			out.append('\n' + NO_NEWLINE)
+
+	out = [ "--- %s\n" % (oldname), "+++ %s\n" % (newname) ]
+	offset = 0
+	idx = 0
+	while idx < len(replaced):
+		# Regions whose context overlaps or touches end up in the same hunk
+		end = idx + 1
+		while end < len(replaced) and replaced[end][0] - replaced[end-1][1] <= 2 * context:
+			end += 1
+
+		oldfirst = max(0, replaced[idx][0] - context)
+		oldlast = min(nlines, replaced[end-1][1] + context)
+		header = len(out)
+		out.append(None)
+
+		newlength = oldlast - oldfirst
+		newfirst = oldfirst + offset
+		pos = oldfirst
+		for first, last, new in replaced[idx:end]:
+			for i in xrange(pos, first):
+				line(' ', i)
+			for i in xrange(first, last):
+				line('-', i)
+			newlines = split_lines(new)
+			for newline in newlines:
+				out.append('+' + newline)
+			if newlines and newlines[-1][-1] != '\n':
+				out.append('\n' + NO_NEWLINE)
+			newlength += len(newlines) - (last - first)
+			offset += len(newlines) - (last - first)
+			pos = last
+		for i in xrange(pos, oldlast):
+			line(' ', i)
+
+		out[header] = "@@ -%s +%s @@\n" % (
+			format_range(oldfirst, oldlast - oldfirst), format_range(newfirst, newlength)
+		)
+		idx = end
+	return ''.join(out)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011 Nicolai Hähnle <nhaehnle@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Ask a local git repository which files have changed, so that periodic runs
+only need to look at files that changed since the previous run.
+"""
+
+import fnmatch
+import os
+import subprocess
+
+def run(args, cwd=None):
+	"""
+	Run git with the given arguments and return its output.
+	Raises ValueError if git fails.
+	"""
+	proc = subprocess.Popen(
+		["git"] + args, cwd=cwd,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE
+	)
+	out, err = proc.communicate()
+	if proc.returncode != 0:
+		raise ValueError("git %s: %s" % (args[0], err.strip() or "failed"))
+	return out
+
+def toplevel(cwd=None):
+	"""
+	Return the top-level directory of the working tree containing cwd.
+	"""
+	return run(["rev-parse", "--show-toplevel"], cwd).strip()
+
+def revision(rev, cwd=None):
+	"""
+	Return the commit id of the given revision.
+	"""
+	return run(["rev-parse", "--verify", "%s^{commit}" % (rev)], cwd).strip()
+
+def changed_files(rev=None, cwd=None):
+	"""
+	Return the absolute paths of all files in the working tree that differ from the given
+	revision (whether committed, staged or not) or are untracked and not ignored.
+	Deleted files are not included. If rev is None, return all files that are tracked or
+	untracked and not ignored.
+	"""
+	top = toplevel(cwd)
+	if rev != None:
+		names = run(["diff", "--name-only", "-z", revision(rev, top), "--"], top).split('\0')
+	else:
+		names = run(["ls-files", "--cached", "--full-name", "-z"], top).split('\0')
+	names += run(["ls-files", "--others", "--exclude-standard", "--full-name", "-z"], top).split('\0')
+
+	result = set()
+	for name in names:
+		path = os.path.join(top, name)
+		if name and os.path.isfile(path):
+			result.add(os.path.realpath(path))
+	return result
+
+def select(changed, paths, patterns=None):
+	"""
+	Return the changed files that are among the given files or inside the given directories,
+	sorted and relative to the current directory.
+
+	If patterns is given, files inside the directories are only returned if their name matches
+	one of these glob patterns (as in fnmatch); the given files are returned regardless.
+	"""
+	result = []
+	for path in changed:
+		for selector in paths:
+			selector = os.path.realpath(selector)
+			if path == selector:
+				result.append(os.path.relpath(path))
+				break
+			if path.startswith(os.path.join(selector, '')):
+				name = os.path.basename(path)
+				if patterns == None or [pattern for pattern in patterns if fnmatch.fnmatch(name, pattern)]:
+					result.append(os.path.relpath(path))
+					break
+	result.sort()
+	return result
+
+class State(object):
+	"""
+	Small state file remembering the last processed revision for every script.
+
+	Each line holds a revision and the absolute path of a script, separated by a space.
+	"""
+	def __init__(self, fname):
+		self.fname = fname
+		self.revisions = {}
+		if os.path.exists(fname):
+			with open(fname, 'r') as filp:
+				for line in filp:
+					line = line.rstrip('\n')
+					if line:
+						rev, script = line.split(' ', 1)
+						self.revisions[script] = rev
+
+	def get(self, script):
+		return self.revisions.get(os.path.realpath(script))
+
+	def set(self, script, rev):
+		self.revisions[os.path.realpath(script)] = rev
+
+	def save(self):
+		tmpname = self.fname + ".tmp"
+		with open(tmpname, 'w') as filp:
+			for script in sorted(self.revisions):
+				print >>filp, "%s %s" % (self.revisions[script], script)
+		os.rename(tmpname, self.fname)
+
+def default_state_file(cwd=None):
+	"""
+	Return the default location of the state file, inside the repository's git directory.
+	"""
+	path = run(["rev-parse", "--git-path", "patrex-state"], cwd).strip()
+	return os.path.join(cwd or os.getcwd(), path)
@@ -23,37 +23,95 @@
 
 """
 Non-deterministic finite automaton (NFA) for tokenized trees.
+
+Transition matching functions describe themselves with attributes, so that they
+can be analyzed without calling them: key for functions that only look at a single
+token, and sublist, negated or descend for functions that run an NFA themselves.
 """
 
+import sys
+import time
+
+from parse import token_bit
 from text import TextRange
 
+class BudgetExceeded(Exception):
+	"""
+	Raised when running an NFA exceeds its Budget.
+
+	context lists (nfa, states) pairs of the runs that were interrupted, innermost first.
+	"""
+	def __init__(self, msg):
+		super(BudgetExceeded, self).__init__(msg)
+		self.context = []
+
+class Budget(object):
+	"""
+	Limits on the work done by NFA runs between calls to reset(): the number of steps
+	(one per token and run, including runs on sub-lists and look-aheads), the number of
+	simultaneously active states in any run, and the wall time in seconds.
+	None means unlimited.
+	"""
+	# Number of steps between checks of the wall time
+	CLOCK_INTERVAL = 256
+
+	def __init__(self, steps=None, states=None, seconds=None):
+		self.maxsteps = steps
+		self.maxstates = states
+		self.maxseconds = seconds
+		self.reset()
+
+	def reset(self):
+		self.steps = 0
+		self.started = time.time()
+
+	def charge(self, states):
+		"""
+		Account for one step of a run with the given set of active states.
+		"""
+		self.steps += 1
+		if self.maxsteps != None and self.steps > self.maxsteps:
+			raise BudgetExceeded("more than %d NFA steps" % (self.maxsteps))
+		if self.maxstates != None and len(states) > self.maxstates:
+			raise BudgetExceeded("more than %d active NFA states" % (self.maxstates))
+		if (self.maxseconds != None and self.steps % Budget.CLOCK_INTERVAL == 0 and
+		    time.time() - self.started > self.maxseconds):
+			raise BudgetExceeded("more than %g seconds" % (self.maxseconds))
+
 def compute_prev(before, block, idx, after):
 	"""
 	Get the token just before the gap before block[idx] (inspecting inside lists)
 	"""
-	if idx == 0:
-		return before
-	else:
+	while idx > 0:
 		prev = block[idx-1]
-		if type(prev) == list:
-			if not prev:
-				return compute_prev(before, block, idx-1, after)
+		if not isinstance(prev, list):
+			return prev
+		if prev:
 			return prev[-1]
-		return prev
+		idx -= 1
+	return before
 
 def compute_next(before, block, idx, after):
 	"""
 	Get the token just after the gap before block[idx] (inspecting inside lists)
 	"""
-	if idx == len(block):
-		return after
-	else:
+	while idx < len(block):
 		next = block[idx]
-		if type(next) == list:
-			if not next:
-				return compute_next(before, block, idx+1, after)
+		if not isinstance(next, list):
+			return next
+		if next:
 			return next[0]
-		return next
+		idx += 1
+	return after
+
+def token_key(token):
+	"""
+	Return what transitions matching a single token look at: its text and tag,
+	or None if it is not a token.
+	"""
+	if isinstance(token, TextRange):
+		return (str(token), token.tag)
+	return None
 
 def nfa_token(token):
 	"""
@@ -65,6 +123,7 @@ def nfa_token(token):
 			return {}
 		return None
 	inner.func_name = "token(%s)" % (token)
+	inner.key = ("token", str(token))
 	return inner
 
 def nfa_tag(tag):
@@ -76,6 +135,7 @@ def nfa_tag(tag):
 			return {}
 		return None
 	inner.func_name = "tag(%s)" % (tag)
+	inner.key = ("tag", tag)
 	return inner
 
 def nfa_list(nfa, startstate, endstate):
@@ -84,7 +144,7 @@ def nfa_list(nfa, startstate, endstate):
 	the given NFA, starting at startstate and ending at endstate
 	"""
 	def inner(before, block, idx, after):
-		if type(block[idx]) == list:
+		if isinstance(block[idx], list):
 			subbefore = compute_prev(before, block, idx, after)
 			subafter = compute_next(before, block, idx+1, after)
 			endstates = nfa(block[idx], startstate, subbefore, subafter)
@@ -93,6 +153,22 @@ def nfa_list(nfa, startstate, endstate):
 		return None
 	inner.func_name = "list(%d, %d)" % (startstate, endstate)
 	inner.write = nfa.write
+	inner.sublist = (nfa, startstate, endstate)
+	return inner
+
+def nfa_descend(nfa, startstate):
+	"""
+	Return a transition matching function that never matches, but searches sublists
+	with the given NFA starting at startstate, for the side effects of its callbacks.
+	"""
+	def inner(before, block, idx, after):
+		if isinstance(block[idx], list):
+			subbefore = compute_prev(before, block, idx, after)
+			subafter = compute_next(before, block, idx+1, after)
+			nfa.search(block[idx], startstate, subbefore, subafter)
+		return None
+	inner.func_name = "descend(%d)" % (startstate)
+	inner.descend = (nfa, startstate)
 	return inner
 
 def nfa_any():
@@ -102,6 +178,7 @@ def nfa_any():
 	def inner(before, block, idx, after):
 		return {}
 	inner.func_name = "any"
+	inner.key = ("any",)
 	return inner
 
 def nfa_not(nfa, startstate, endstate):
@@ -115,8 +192,154 @@ def nfa_not(nfa, startstate, endstate):
 			return {}
 		return None
 	inner.func_name = "not(%d, %d)" % (startstate, endstate)
+	inner.negated = (nfa, startstate, endstate)
 	return inner
 
+class Dispatch(object):
+	"""
+	Index of the matching transitions of a state by what they match (see Nfa.dispatch), or of
+	its epsilon transitions by what the threads following them match next (see Nfa.fanout).
+
+	bytoken and bytag map token strings and tags to the transitions matching only those, and
+	rest lists all other transitions. local says whether all transitions only depend on the
+	token itself (so that their results can be cached per token). positions maps every
+	transition to its original position, and nested is the set of transitions whose matching
+	functions run an NFA.
+	"""
+	__slots__ = [ "bytoken", "bytag", "rest", "local", "positions", "nested" ]
+
+	def __init__(self, bytoken, bytag, rest, local, positions, nested):
+		self.bytoken = bytoken
+		self.bytag = bytag
+		self.rest = rest
+		self.local = local
+		self.positions = positions
+		self.nested = nested
+
+class Pending(Exception):
+	"""
+	Raised by capture-free matching when the results of recognizing sub-lists or look-aheads are
+	needed but not yet known. Nfa.resolve computes them on an explicit stack, and the step that
+	raised this is then simply retried.
+	"""
+	def __init__(self, recognitions):
+		super(Pending, self).__init__()
+		self.recognitions = recognitions
+
+class Recognition(object):
+	"""
+	Suspendable capture-free run of an NFA on tree[first:], starting at startstate.
+
+	If goalstate is None, the run continues until the end of the tree and its result is the set of
+	reachable states; otherwise, it stops when the goalstate is reached, and the result is whether
+	that happens. Either way, the result also says whether any callback is triggered on the way.
+
+	If trace is set to a list, the run appends a tuple (stepped, closed, stepevent, hit) for every
+	position it reaches: the states before and after the epsilon closure, whether a callback is
+	triggered inside the step to that position, and whether one is triggered by the closure
+	(see Nfa.find_spans). If last is lowered, the run pauses at that position, and its result is
+	only partial (and not remembered by Nfa.resolve).
+	"""
+	__slots__ = [
+		"nfa", "tree", "idx", "last", "startstate", "goalstate", "before", "after", "key", "states", "event", "trace"
+	]
+
+	def __init__(self, nfa, tree, first, startstate, goalstate, before, after, key):
+		self.nfa = nfa
+		self.tree = tree
+		self.idx = first
+		self.last = len(tree)
+		self.startstate = startstate
+		self.goalstate = goalstate
+		self.before = before
+		self.after = after
+		self.key = key
+		self.states, self.event = nfa.closure(frozenset([startstate]))
+		self.trace = None
+
+	def advance(self, blocks):
+		"""
+		Continue the run until it is finished and return its result, or raise Pending.
+		"""
+		# This loop runs for every token of every recognized list, so keep lookups out of it
+		nfa = self.nfa
+		step = nfa.step
+		closure = nfa.closure
+		budget = nfa.budget
+		trace = self.trace
+		tree = self.tree
+		before = self.before
+		after = self.after
+		goalstate = self.goalstate
+		idx = self.idx
+		end = self.last
+		states = self.states
+		event = self.event
+		try:
+			while idx < end:
+				if not states or goalstate in states:
+					break
+				try:
+					newstates, stepevent = step(states, before, tree, idx, after, blocks)
+				except Pending:
+					# Ask for everything that is missing, so that the step only needs to be retried once
+					raise Pending(nfa.missing(states, before, tree, idx, after, blocks))
+				if budget != None:
+					budget.charge(states)
+				states, hit = closure(newstates)
+				event = event or stepevent or hit
+				idx += 1
+				if trace != None:
+					trace.append((newstates, states, stepevent, hit))
+		finally:
+			self.idx = idx
+			self.states = states
+			self.event = event
+
+		if goalstate != None:
+			return goalstate in states, event
+		return states, event
+
+# Yielded by the generators of nested NFA runs to return their result
+RESULT = "result"
+
+# Passed to Nfa.expand_epsilons by runs for side effects at the end of the tree, where nothing is matched next
+NOTHING = object()
+
+def drive(generator):
+	"""
+	Run a generator of a (possibly nested) NFA run to completion and return its result.
+
+	Nested runs are started by yielding their generator, which is resumed with the nested run's result.
+	The generators are kept on an explicit stack, so that the depth of nesting does not cost Python
+	stack frames. Exceptions are passed on to the generator that started the failing run.
+	"""
+	stack = [generator]
+	value = None
+	error = None
+	while True:
+		try:
+			if error != None:
+				request = stack[-1].throw(*error)
+				error = None
+			else:
+				request = stack[-1].send(value)
+		except Exception:
+			stack.pop()
+			if not stack:
+				raise
+			error = sys.exc_info()
+			continue
+
+		if type(request) == tuple:
+			stack.pop().close()
+			value = request[1]
+			if not stack:
+				return value
+		else:
+			stack.append(request)
+			value = None
+
 class Nfa(object):
 	class State(object):
 		def __init__(self):
@@ -138,18 +361,88 @@ class Nfa(object):
 			self.nextcapture = None
 			self.stack = None
 
+	# Maximum number of entries in each cache of the lazily built DFA before that cache is flushed
+	CACHE_LIMIT = 10000
+
+	# Capture-free recognitions of trees with at most this many levels of nested sub-lists
+	# are finished by recursing instead of on the explicit stack (see inline)
+	INLINE_DEPTH = 50
+
+	# Searches run the NFA directly instead of in two phases on trees with at most SMALL elements,
+	# and when callbacks are triggered on more than one in DENSE of the first SAMPLE positions
+	SMALL = 8
+	SAMPLE = 256
+	DENSE = 16
+
 	def __init__(self):
 		self.states = []
 		self.debug = False
 		self.writing = False
+		self.budget = None
+		# Optimized copy for capture-free recognition and the mapping of states to it, if any
+		self.recognizer = None
+		self.reset_cache()
+
+	def set_budget(self, budget):
+		"""
+		Limit the work done by runs of this NFA and of all NFAs run by its matching functions.
+		"""
+		nfas = [self]
+		while nfas:
+			nfa = nfas.pop()
+			if nfa.budget is budget:
+				continue
+			nfa.budget = budget
+			if nfa.recognizer != None:
+				nfas.append(nfa.recognizer[0])
+			for state in nfa.states:
+				for transition in state.transitions:
+					for attr in [ "sublist", "negated", "descend" ]:
+						if hasattr(transition.match, attr):
+							nfas.append(getattr(transition.match, attr)[0])
+
+	def reachable(self, states):
+		"""
+		Return the set of states that can be reached from the given states by any transitions.
+		"""
+		result = set(states)
+		queue = list(states)
+		while queue:
+			state = queue.pop()
+			for transition in self.states[state].transitions + self.states[state].epsilons:
+				if not transition.end in result:
+					result.add(transition.end)
+					queue.append(transition.end)
+		return result
+
+	def reset_cache(self):
+		"""
+		Forget the lazily built DFA used for capture-free recognition.
+		This must be called when states or transitions are changed after matching has started.
+		"""
+		self.closures = {}
+		self.steps = {}
+		self.moves = {}
+		self.dispatches = {}
+		self.expectations = {}
+		self.lookaheads = {}
+		self.fanouts = {}
+		self.selections = {}
+		self.flatness = {}
+		self.isolation = {}
+		self.requirements = {}
+		self.reverse = None
+		self.blocks = None
 
 	def newstate(self):
 		self.states.append(Nfa.State())
+		self.reset_cache()
 		return len(self.states) - 1
 
 	def transition(self, start, end, match):
 		assert 0 <= start and start < len(self.states)
 		assert 0 <= end and end < len(self.states)
+		self.reset_cache()
 		t = Nfa.Transition(start, end, match)
 		if match != None:
 			self.states[start].transitions.append(t)
@@ -169,27 +462,51 @@ class Nfa(object):
 			oldstate = subnfa.states[oldidx]
 			newstate = self.states[statemap[oldidx]]
 			for t in oldstate.transitions:
-				self.transition(statemap[t.start], statemap[t.end], match=t.match)
+				newt = self.transition(statemap[t.start], statemap[t.end], match=t.match)
+				newt.priority = t.priority
 			for t in oldstate.epsilons:
 				newt = self.transition(statemap[t.start], statemap[t.end], match=None)
+				newt.priority = t.priority
 				newt.callback = t.callback
 				newt.prevcapture = t.prevcapture
 				newt.nextcapture = t.nextcapture
+				newt.stack = t.stack
 
 		return statemap
 
-	def expand_epsilons(self, states, prev, next):
-		while type(prev) == list:
+	def expand_epsilons(self, states, prev, next, ahead=None):
+		"""
+		Follow the epsilon transitions from the given dict of states to (priority, stack) in place.
+
+		Threads are expanded in the order of their states (see run). If ahead is given, it is the
+		element of the tree that is matched next (or NOTHING at the end of the tree), and transitions
+		after which no thread can match it are not followed (see fanout). Such threads only lead to
+		states that no other thread can get past either, so this does not change which thread wins
+		any other state. It must only be used when the states reached at the end are of no interest.
+
+		Callbacks are triggered after the closure is complete, ordered by the states their
+		transitions start from (so that those of several rules run in the order of the rules).
+		"""
+		while isinstance(prev, list):
 			prev = prev[-1]
-		while type(next) == list:
+		while isinstance(next, list):
 			next = next[0]
 
-		queue = states.items()
+		fanouts = self.fanouts
+		aheadkey = token_key(ahead)
+		queue = sorted(states.items(), reverse=True)
+		triggered = []
 		while queue:
 			state,data = queue.pop()
 			prio,stack = data
 
-			for transition in self.states[state].epsilons:
+			epsilons = self.states[state].epsilons
+			if ahead != None and epsilons:
+				epsilons = fanouts.get((state, aheadkey))
+				if epsilons == None:
+					epsilons = self.fanout(state, ahead)
+					self.remember(fanouts, (state, aheadkey), epsilons)
+			for transition in epsilons:
 				newprio = prio
 				if transition.priority != None:
 					newprio = transition.priority
@@ -223,9 +540,13 @@ class Nfa(object):
 				queue.append((transition.end, (newprio, newstack)))
 
 				if transition.callback:
-					transition.callback(newstack[-1])
+					triggered.append((transition.start, transition.callback, newstack[-1]))
+
+		triggered.sort(key=lambda item: item[0])
+		for start, callback, kv in triggered:
+			callback(kv)
 
-	def __call__(self, tree, startstate, beforetoken=None, aftertoken=None, goalstate=None):
+	def __call__(self, tree, startstate, beforetoken=None, aftertoken=None, goalstate=None, first=0, last=None):
 		"""
 		Run the NFA on the given tree from the given startstate.
 
@@ -236,58 +557,764 @@ class Nfa(object):
 		is reached by the NFA. If the goalstate is never reached, return None.
 
 		beforetoken and aftertoken are used for the purpose of position matching ($<|pos| and $>|pos| patterns).
+
+		first and last can be used to run the NFA only on the span tree[first:last], while still treating the
+		tokens outside of the span as the surrounding context.
 		"""
-		states = { startstate: (None, [{}]) }
-		self.expand_epsilons(states, beforetoken, compute_next(beforetoken, tree, 0, aftertoken))
+		return drive(self.run(tree, startstate, beforetoken, aftertoken, goalstate, first, last))
 
-		for idx in range(len(tree)):
-			if self.debug:
-				print "%d = %s" % (idx, tree[idx]), states.keys()
+	def run(self, tree, startstate, beforetoken, aftertoken, goalstate, first, last, searching=False):
+		"""
+		Generator for __call__, which runs nested NFAs of sub-lists and look-aheads via drive.
+
+		If searching is set, the run is only done for the side effects of its callbacks (see search),
+		and the states reached at the end are not returned.
 
-			if not states:
-				if goalstate:
-					return None
-				return {}
-			if goalstate and goalstate in states:
-				return states[goalstate][1][-1]
+		The first thread that reaches a state keeps it, unless an epsilon transition with a higher
+		priority takes it over. Threads are stepped in the order of their states, so that which one
+		wins does not depend on which other threads exist.
+		"""
+		if last == None:
+			last = len(tree)
 
-			newstates = {}
-			for state,data in states.iteritems():
-				prio,stack = data
+		# Threads that die at the next step can only be skipped if the states that are reached at
+		# the goalstate are of no interest, and those reached at the end only matter when searching
+		def ahead(idx):
+			if goalstate != None:
+				return None
+			if idx < last:
+				return tree[idx]
+			if searching:
+				return NOTHING
+			return None
 
-				for transition in self.states[state].transitions:
-					newprio = prio
-					if transition.priority != None:
-						newprio = transition.priority
+		# Matching transitions (and those running an NFA) that may match the token at each state
+		selections = self.selections
 
-					if transition.end in newstates and newstates[transition.end][1] >= newprio:
-						continue
+		states = { startstate: (None, [{}]) }
+		self.expand_epsilons(
+			states,
+			compute_prev(beforetoken, tree, first, aftertoken),
+			compute_next(beforetoken, tree, first, aftertoken),
+			ahead(first)
+		)
 
-					matchkv = transition.match(beforetoken, tree, idx, aftertoken)
-					if matchkv == None:
-						continue
+		try:
+			for idx in range(first, last):
+				if self.debug:
+					print "%d = %s" % (idx, tree[idx]), states.keys()
 
-					if matchkv:
-						newstack = stack[:]
-						newstack[-1] = newstack[-1].copy()
-						newstack[-1].update(matchkv)
+				if not states:
+					if goalstate:
+						yield (RESULT, None)
 					else:
-						newstack = stack
-					newstates[transition.end] = (newprio, newstack)
-
-			states = newstates
-			self.expand_epsilons(
-				states,
-				compute_prev(beforetoken, tree, idx+1, aftertoken),
-				compute_next(beforetoken, tree, idx+1, aftertoken)
-			)
+						yield (RESULT, {})
+					return
+				if goalstate and goalstate in states:
+					yield (RESULT, states[goalstate][1][-1])
+					return
+				if self.budget != None:
+					self.budget.charge(states)
+
+				token = tree[idx]
+				tokenkey = token_key(token)
+				newstates = {}
+				for state in sorted(states):
+					prio,stack = states[state]
+					selection = selections.get((state, tokenkey))
+					if selection == None:
+						dispatch = self.dispatch(state)
+						selection = (self.select(dispatch, token), dispatch.nested)
+						self.remember(selections, (state, tokenkey), selection)
+					candidates, nested = selection
+
+					for transition in candidates:
+						newprio = prio
+						if transition.priority != None:
+							newprio = transition.priority
+
+						if transition.end in newstates and newstates[transition.end][1] >= newprio:
+							continue
+
+						if transition in nested:
+							# Only look-aheads can match single tokens
+							if not isinstance(token, list) and not hasattr(transition.match, "negated"):
+								continue
+							matchkv = yield self.run_match(transition.match, beforetoken, tree, idx, aftertoken)
+						else:
+							matchkv = transition.match(beforetoken, tree, idx, aftertoken)
+						if matchkv == None:
+							continue
+
+						if matchkv:
+							newstack = stack[:]
+							newstack[-1] = newstack[-1].copy()
+							newstack[-1].update(matchkv)
+						else:
+							newstack = stack
+						newstates[transition.end] = (newprio, newstack)
+
+				states = newstates
+				self.expand_epsilons(
+					states,
+					compute_prev(beforetoken, tree, idx+1, aftertoken),
+					compute_next(beforetoken, tree, idx+1, aftertoken),
+					ahead(idx+1)
+				)
+		except BudgetExceeded as e:
+			e.context.append((self, frozenset(states)))
+			raise
 
 		if goalstate:
 			if goalstate in states:
-				return states[goalstate][-1]
+				yield (RESULT, states[goalstate][-1])
 			else:
-				return None
-		return dict((state,data[1][-1]) for state,data in states.iteritems())
+				yield (RESULT, None)
+		elif searching:
+			yield (RESULT, None)
+		else:
+			yield (RESULT, dict((state,data[1][-1]) for state,data in states.iteritems()))
+
+	def run_match(self, match, before, block, idx, after):
+		"""
+		Generator for calling a matching function that runs an NFA itself (see nfa_list, nfa_not
+		and nfa_descend), which runs that NFA via drive.
+		"""
+		if hasattr(match, "negated"):
+			nfa, startstate, endstate = match.negated
+			kv = yield nfa.run(block[idx:], startstate, compute_prev(before, block, idx, after), after, endstate, 0, None)
+			if kv == None:
+				yield (RESULT, {})
+			else:
+				yield (RESULT, None)
+			return
+
+		result = None
+		if isinstance(block[idx], list):
+			subbefore = compute_prev(before, block, idx, after)
+			subafter = compute_next(before, block, idx+1, after)
+			if hasattr(match, "sublist"):
+				nfa, startstate, endstate = match.sublist
+				if not nfa.excluded(block[idx], startstate, endstate):
+					endstates = yield nfa.run(block[idx], startstate, subbefore, subafter, None, 0, None)
+					if endstate in endstates:
+						result = endstates[endstate]
+			else:
+				nfa, startstate = match.descend
+				if not nfa.excluded(block[idx], startstate, None):
+					yield nfa.run_search(block[idx], startstate, subbefore, subafter)
+		yield (RESULT, result)
+
+	def dispatch(self, state):
+		"""
+		Index the matching transitions of the given state by what they match, so that states
+		with many literal transitions (e.g. the shared start of many rules) need not try them all.
+
+		Returns a Dispatch.
+		"""
+		result = self.dispatches.get(state)
+		if result != None:
+			return result
+
+		bytoken = {}
+		bytag = {}
+		rest = []
+		local = True
+		for transition in self.states[state].transitions:
+			key = getattr(transition.match, "key", None)
+			if key != None and key[0] == "token":
+				bytoken.setdefault(key[1], []).append(transition)
+			elif key != None and key[0] == "tag":
+				bytag.setdefault(key[1], []).append(transition)
+			else:
+				rest.append(transition)
+			if hasattr(transition.match, "negated") or not (
+			   hasattr(transition.match, "key") or
+			   hasattr(transition.match, "sublist") or
+			   hasattr(transition.match, "descend")):
+				local = False
+
+		positions = dict((transition, pos) for pos,transition in enumerate(self.states[state].transitions))
+		nested = set(
+			transition for transition in self.states[state].transitions
+			if hasattr(transition.match, "sublist") or hasattr(transition.match, "negated") or
+			   hasattr(transition.match, "descend")
+		)
+		result = Dispatch(bytoken, bytag, rest, local, positions, nested)
+		self.dispatches[state] = result
+		return result
+
+	def candidates(self, state, token):
+		"""
+		Return the matching transitions of the given state that may match token, in their original order.
+		"""
+		return self.select(self.dispatch(state), token)
+
+	def select(self, dispatch, token):
+		"""
+		Return the transitions of a Dispatch that are not ruled out by token, in their original order.
+		"""
+		if not dispatch.bytoken and not dispatch.bytag:
+			return dispatch.rest
+		if not isinstance(token, TextRange):
+			return dispatch.rest
+
+		found = [
+			lst for lst in (dispatch.bytoken.get(str(token)), dispatch.bytag.get(token.tag), dispatch.rest)
+			if lst
+		]
+		if len(found) == 1:
+			return found[0]
+		if not found:
+			return found
+		return sorted(set(sum(found, [])), key=dispatch.positions.__getitem__)
+
+	def expectation(self, state):
+		"""
+		Return the frozensets (texts, tags) of literal tokens and tags such that every thread at the given
+		state must match one of them in its next step, or None if a thread may match anything else or
+		trigger a callback before that.
+		"""
+		if state in self.expectations:
+			return self.expectations[state]
+
+		texts = set()
+		tags = set()
+		result = (texts, tags)
+		closed = set([state])
+		queue = [state]
+		while queue and result != None:
+			current = queue.pop()
+			for transition in self.states[current].epsilons:
+				if transition.callback:
+					result = None
+				if not transition.end in closed:
+					closed.add(transition.end)
+					queue.append(transition.end)
+			for transition in self.states[current].transitions:
+				key = getattr(transition.match, "key", None)
+				if key != None and key[0] == "token":
+					texts.add(key[1])
+				elif key != None and key[0] == "tag":
+					tags.add(key[1])
+				else:
+					result = None
+
+		if result != None:
+			result = (frozenset(texts), frozenset(tags))
+		self.expectations[state] = result
+		return result
+
+	def fanout(self, state, token):
+		"""
+		Return the epsilon transitions of the given state in their original order, leaving out those
+		after which no thread can match token in its next step (see expectation), unless token is None.
+
+		This keeps runs from expanding every one of many rules hanging off a shared start state
+		(and copying captures for them) on every token, when only those starting with the token can match.
+		"""
+		if token == None:
+			return self.states[state].epsilons
+
+		dispatch = self.lookaheads.get(state)
+		if dispatch == None:
+			bytoken = {}
+			bytag = {}
+			rest = []
+			for transition in self.states[state].epsilons:
+				expected = None
+				if not transition.callback:
+					expected = self.expectation(transition.end)
+				if expected == None:
+					rest.append(transition)
+					continue
+				for text in expected[0]:
+					bytoken.setdefault(text, []).append(transition)
+				for tag in expected[1]:
+					bytag.setdefault(tag, []).append(transition)
+			positions = dict((transition, pos) for pos,transition in enumerate(self.states[state].epsilons))
+			dispatch = Dispatch(bytoken, bytag, rest, True, positions, frozenset())
+			self.lookaheads[state] = dispatch
+		return self.select(dispatch, token)
+
+	def isolated(self, state):
+		"""
+		Check whether all threads that can be at the given state are equivalent, because the state
+		can only be reached by its own loops, and those neither capture nor change priorities.
+		"""
+		if not state in self.isolation:
+			self.isolation[state] = self.check_isolated(state)
+		return self.isolation[state]
+
+	def check_isolated(self, state):
+		for origin in self.states:
+			for transition in origin.transitions + origin.epsilons:
+				if transition.end != state:
+					continue
+				if transition.start != state:
+					return False
+				if transition.match == None:
+					if (transition.priority != None or transition.callback or transition.stack != None or
+					    transition.prevcapture or transition.nextcapture):
+						return False
+				elif not hasattr(transition.match, "key") and not hasattr(transition.match, "descend"):
+					return False
+		return True
+
+	def closure(self, states):
+		"""
+		Capture-free counterpart of expand_epsilons on a frozenset of states.
+
+		Returns the closed frozenset and whether a callback is triggered along the way.
+		The result is cached, so that the closed sets act as the states of a lazily built DFA.
+		"""
+		result = self.closures.get(states)
+		if result != None:
+			return result
+
+		closed = set(states)
+		queue = list(states)
+		hit = False
+		while queue:
+			state = queue.pop()
+			for transition in self.states[state].epsilons:
+				if transition.callback:
+					hit = True
+				if not transition.end in closed:
+					closed.add(transition.end)
+					queue.append(transition.end)
+
+		result = (frozenset(closed), hit)
+		self.remember(self.closures, states, result)
+		return result
+
+	def remember(self, cache, key, value):
+		"""
+		Store a result in one of the caches of the lazily built DFA, flushing the cache when it is full.
+		"""
+		if len(cache) >= Nfa.CACHE_LIMIT:
+			cache.clear()
+		cache[key] = value
+
+	def test(self, transition, before, tree, idx, after, blocks):
+		"""
+		Capture-free evaluation of a matching transition on tree[idx].
+
+		Sub-lists and negations are recognized without capturing as well, taking their results
+		from blocks (see resolve); Pending is raised if they are not known yet.
+		Returns whether the transition matches, and whether a callback is triggered inside
+		some sub-list or negation.
+		"""
+		match = transition.match
+		if hasattr(match, "sublist") or hasattr(match, "descend"):
+			if not isinstance(tree[idx], list):
+				return False, False
+			if hasattr(match, "sublist"):
+				subnfa, substart, subend = match.sublist
+			else:
+				subnfa, substart = match.descend
+				subend = None
+			if subnfa.excluded(tree[idx], substart, subend):
+				return False, False
+			key = (id(subnfa), id(tree[idx]), substart)
+			result = blocks.get(key)
+			if result == None:
+				result = subnfa.inline(Recognition(
+					subnfa, tree[idx], 0, substart, None,
+					compute_prev(before, tree, idx, after),
+					compute_next(before, tree, idx+1, after),
+					key
+				), blocks)
+			endset, event = result
+			return subend in endset, event
+		elif hasattr(match, "negated"):
+			subnfa, substart, subend = match.negated
+			key = (id(subnfa), id(tree), idx, substart, subend)
+			result = blocks.get(key)
+			if result == None:
+				result = subnfa.inline(Recognition(subnfa, tree, idx, substart, subend, before, after, key), blocks)
+			reached, event = result
+			return not reached, event
+		return match(before, tree, idx, after) != None, False
+
+	def requirement(self, startstate, goalstate):
+		"""
+		Return a mask of token bits such that every run from startstate must match a token with
+		one of those bits before it can reach goalstate or trigger a callback (also inside sub-lists,
+		look-aheads and nested searches), or None if no such mask is known.
+		"""
+		key = (startstate, goalstate)
+		if key in self.requirements:
+			return self.requirements[key]
+		# Be conservative about recursive sub-lists
+		self.requirements[key] = None
+
+		mask = 0
+		queue = [(self, startstate, goalstate)]
+		seen = set(queue)
+		def visit(item):
+			if not item in seen:
+				seen.add(item)
+				queue.append(item)
+
+		while queue and mask != None:
+			nfa, state, goal = queue.pop()
+			if state == goal or [transition for transition in nfa.states[state].epsilons if transition.callback]:
+				mask = None
+				break
+			for transition in nfa.states[state].epsilons:
+				visit((nfa, transition.end, goal))
+			for transition in nfa.states[state].transitions:
+				match = transition.match
+				if getattr(match, "key", (None,))[0] == "token":
+					mask |= token_bit(match.key[1])
+				elif hasattr(match, "descend"):
+					# A nested search runs on a sub-list, whose tokens are part of the tree as well
+					visit((match.descend[0], match.descend[1], None))
+				elif hasattr(match, "sublist"):
+					subnfa, substart, subend = match.sublist
+					submask = subnfa.requirement(substart, subend)
+					if submask != None:
+						mask |= submask
+					else:
+						visit((subnfa, substart, None))
+						visit((nfa, transition.end, goal))
+				else:
+					if hasattr(match, "negated"):
+						visit((match.negated[0], match.negated[1], None))
+					visit((nfa, transition.end, goal))
+
+		self.requirements[key] = mask
+		return mask
+
+	def excluded(self, tree, startstate, goalstate):
+		"""
+		Check whether the summary of the tree (see patre.parse.Group) proves that a run on it
+		from startstate can neither reach goalstate nor trigger a callback.
+		"""
+		summary = getattr(tree, "summary", None)
+		if summary == None:
+			return False
+		mask = self.requirement(startstate, goalstate)
+		return mask != None and not mask & summary
+
+	def flat(self, state):
+		"""
+		Whether no matching function that runs an NFA can be reached from the given state.
+		"""
+		if not state in self.flatness:
+			self.flatness[state] = not [
+				transition for reached in self.reachable([state]) for transition in self.dispatch(reached).nested
+			]
+		return self.flatness[state]
+
+	def inline(self, recognition, blocks):
+		"""
+		Finish a Recognition that a capture-free step depends on right away, if that cannot lead
+		to further nesting or only to nesting of bounded depth. Otherwise, raise Pending to have
+		it resolved on the explicit stack.
+		"""
+		depth = getattr(recognition.tree, "depth", None)
+		if (depth == None or depth > Nfa.INLINE_DEPTH) and not self.flat(recognition.startstate):
+			raise Pending([recognition])
+		result = recognition.advance(blocks)
+		blocks[recognition.key] = result
+		return result
+
+	def missing(self, states, before, tree, idx, after, blocks):
+		"""
+		Return Recognitions for all results of sub-lists and look-aheads that a step of the given
+		states on tree[idx] may need and that are not yet known.
+		"""
+		missing = []
+		for transition in [t for state in states for t in self.dispatch(state).nested]:
+			match = transition.match
+			if hasattr(match, "negated"):
+				subnfa, substart, subend = match.negated
+				key = (id(subnfa), id(tree), idx, substart, subend)
+				if not key in blocks:
+					missing.append(Recognition(subnfa, tree, idx, substart, subend, before, after, key))
+				continue
+
+			if not isinstance(tree[idx], list):
+				continue
+			if hasattr(match, "sublist"):
+				subnfa, substart, subend = match.sublist
+			else:
+				subnfa, substart = match.descend
+				subend = None
+			if subnfa.excluded(tree[idx], substart, subend):
+				continue
+			key = (id(subnfa), id(tree[idx]), substart)
+			if not key in blocks:
+				missing.append(Recognition(
+					subnfa, tree[idx], 0, substart, None,
+					compute_prev(before, tree, idx, after),
+					compute_next(before, tree, idx+1, after),
+					key
+				))
+		return missing
+
+	def transitions_from(self, state, before, tree, idx, after, blocks):
+		"""
+		Capture-free evaluation of all matching transitions of the given state on tree[idx].
+
+		Returns the list of states that are reached and whether a callback is triggered inside
+		some sub-list or negation.
+		"""
+		token = tree[idx]
+		key = None
+		if isinstance(token, TextRange):
+			key = (state, str(token), token.tag)
+			ends = self.moves.get(key)
+			if ends != None:
+				return ends, False
+
+		ends = []
+		event = False
+		for transition in self.candidates(state, token):
+			matched, subevent = self.test(transition, before, tree, idx, after, blocks)
+			if matched:
+				ends.append(transition.end)
+			event = event or subevent
+
+		if key != None and self.dispatch(state).local:
+			self.remember(self.moves, key, ends)
+		return ends, event
+
+	def step(self, states, before, tree, idx, after, blocks):
+		"""
+		Capture-free counterpart of a single step of __call__ on a frozenset of states.
+
+		Returns the (not yet closed) frozenset of states after matching tree[idx], and
+		whether a callback is triggered inside some sub-list or negation.
+		"""
+		token = tree[idx]
+		key = None
+		if isinstance(token, TextRange):
+			key = (states, str(token), token.tag)
+			newstates = self.steps.get(key)
+			if newstates != None:
+				return newstates, False
+
+		newstates = set()
+		event = False
+		cacheable = True
+		for state in states:
+			ends, subevent = self.transitions_from(state, before, tree, idx, after, blocks)
+			newstates.update(ends)
+			event = event or subevent
+			if key != None and not (state, key[1], key[2]) in self.moves:
+				cacheable = False
+
+		newstates = frozenset(newstates)
+		if cacheable and key != None:
+			self.remember(self.steps, key, newstates)
+		return newstates, event
+
+	def resolve(self, recognition, blocks):
+		"""
+		Finish the given Recognition (up to its last position) and return its result, after finishing all the recognitions
+		of sub-lists and look-aheads it depends on. Those are kept on an explicit stack instead
+		of recursing, and all results are remembered in blocks.
+		"""
+		stack = [recognition]
+		while stack:
+			top = stack[-1]
+			if top is not recognition and top.key in blocks:
+				# The same recognition may have been requested more than once
+				stack.pop()
+				continue
+			try:
+				result = top.advance(blocks)
+			except Pending as pending:
+				stack += pending.recognitions
+				continue
+			except BudgetExceeded as e:
+				for suspended in reversed(stack):
+					e.context.append((suspended.nfa, suspended.states))
+				raise
+			if top.last == len(top.tree):
+				blocks[top.key] = result
+			stack.pop()
+		return result
+
+	def resolving(self, blocks, function, *args):
+		"""
+		Call a capture-free matching function, resolving the recognitions it is waiting for.
+		"""
+		while True:
+			try:
+				return function(*args)
+			except Pending as pending:
+				for recognition in pending.recognitions:
+					self.resolve(recognition, blocks)
+
+	def ancestors(self, states, within):
+		"""
+		Return the states in within from which one of the given states can be reached by epsilon transitions.
+		"""
+		result = set(states)
+		queue = list(states)
+		while queue:
+			state = queue.pop()
+			for transition in self.reverse[state][1]:
+				if transition.start in within and not transition.start in result:
+					result.add(transition.start)
+					queue.append(transition.start)
+		return result
+
+	def find_spans(self, tree, startstate, beforetoken, aftertoken, trace):
+		"""
+		Find the spans of the tree that must be re-run with captures to trigger all callbacks.
+
+		The trace of the forward capture-free pass (see Recognition) gives the state sets at every
+		position and where callbacks are triggered. A single backward pass then tracks the states from which some callback can
+		still be reached, starting a span whenever a callback is triggered and ending it at the
+		earliest position at which a contributing thread leaves the (isolated) startstate.
+		Touching spans are merged, so that no thread of a re-run span is ever influenced by a
+		thread that started outside of the span.
+		"""
+		if self.reverse == None:
+			self.reverse = [([], []) for state in self.states]
+			for state in self.states:
+				for transition in state.transitions:
+					self.reverse[transition.end][0].append(transition)
+				for transition in state.epsilons:
+					self.reverse[transition.end][1].append(transition)
+
+		stepped = []
+		closed = []
+		events = {}
+		for pos, (newstates, states, event, hit) in enumerate(trace):
+			stepped.append(newstates)
+			closed.append(states)
+			if event:
+				events.setdefault(pos-1, []).append(pos)
+			if hit:
+				events.setdefault(pos, []).append(pos)
+
+		spans = []
+		live = set()
+		for pos in range(max(events.keys() + [-1]), -1, -1):
+			if pos in events:
+				for end in events[pos]:
+					if end == pos:
+						sources = [
+							state for state in closed[pos]
+							if [transition for transition in self.states[state].epsilons if transition.callback]
+						]
+					else:
+						sources = [
+							state for state in closed[pos]
+							if self.resolving(
+								self.blocks, self.transitions_from, state, beforetoken, tree, pos, aftertoken, self.blocks
+							)[1]
+						]
+					if not live:
+						spanend = end
+					spanend = max(spanend, end)
+					live |= self.ancestors(sources, closed[pos])
+			if not live:
+				continue
+
+			if startstate in live or pos == 0:
+				spanstart = pos
+			live.discard(startstate)
+
+			if pos == 0:
+				live = set()
+			else:
+				origins = set()
+				for state in live & stepped[pos]:
+					for transition in self.reverse[state][0]:
+						if (transition.start in closed[pos-1] and not transition.start in origins and
+						    self.resolving(
+								self.blocks, self.test, transition, beforetoken, tree, pos-1, aftertoken, self.blocks
+						    )[0]):
+							origins.add(transition.start)
+				live = self.ancestors(origins, closed[pos-1])
+			if not live:
+				spans.append((spanstart, spanend))
+
+		spans.sort()
+		merged = []
+		for start,end in spans:
+			if merged and start <= merged[-1][1]:
+				merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+			else:
+				merged.append((start, end))
+		return merged
+
+	def search(self, tree, startstate, beforetoken=None, aftertoken=None):
+		"""
+		Run the NFA on the given tree from the given startstate only for the side effects of its callbacks.
+
+		This works in two phases: A capture-free recognizer (using a lazily built DFA, and the optimized
+		copy of the NFA if there is one, see patre.compile.optimize) finds the spans of the tree in
+		which callbacks are triggered, and only those spans are then run with full capture tracking.
+		Callbacks are triggered with the same key-value dicts and in the same order as when running
+		the NFA directly, provided that startstate is isolated (see above); otherwise, this falls
+		back to running the NFA directly. This relies on runs stepping their threads in a fixed order
+		and triggering the callbacks of each position in the order of their states (see run and
+		expand_epsilons), so that the threads that a span leaves out cannot change either. So do searches on small trees and on trees in which
+		callbacks are triggered densely (see SMALL, SAMPLE and DENSE).
+		"""
+		drive(self.run_search(tree, startstate, beforetoken, aftertoken))
+
+	def run_search(self, tree, startstate, beforetoken, aftertoken):
+		"""
+		Generator for search, which runs the spans (and nested searches in them) via drive.
+		"""
+		if self.excluded(tree, startstate, None):
+			yield (RESULT, None)
+			return
+
+		recognizer = self
+		recognizerstart = startstate
+		if self.recognizer != None:
+			recognizer, statemap = self.recognizer
+			recognizerstart = statemap[startstate]
+
+		if not recognizer.isolated(recognizerstart):
+			yield self.run(tree, startstate, beforetoken, aftertoken, None, 0, None, True)
+			yield (RESULT, None)
+			return
+
+		if len(tree) <= Nfa.SMALL:
+			yield self.run(tree, startstate, beforetoken, aftertoken, None, 0, None, True)
+			yield (RESULT, None)
+			return
+
+		outer = recognizer.blocks == None
+		if outer:
+			recognizer.blocks = {}
+		try:
+			trace = []
+			recognition = Recognition(
+				recognizer, tree, 0, recognizerstart, None, beforetoken, aftertoken,
+				(id(recognizer), id(tree), recognizerstart)
+			)
+			recognition.trace = trace
+			trace.append((frozenset([recognizerstart]), recognition.states, False, recognition.event))
+
+			# When callbacks are triggered all over the tree, finding and re-running the spans costs
+			# more than the recognition saves
+			recognition.last = min(Nfa.SAMPLE, len(tree))
+			recognizer.resolve(recognition, recognizer.blocks)
+			events = len([True for stepped, closed, stepevent, hit in trace if stepevent or hit])
+			if events * Nfa.DENSE > len(trace):
+				yield self.run(tree, startstate, beforetoken, aftertoken, None, 0, None, True)
+			else:
+				recognition.last = len(tree)
+				endset, event = recognizer.resolve(recognition, recognizer.blocks)
+				if event:
+					for first,last in recognizer.find_spans(tree, recognizerstart, beforetoken, aftertoken, trace):
+						yield self.run(tree, startstate, beforetoken, aftertoken, None, first, last, True)
+		finally:
+			if outer:
+				recognizer.blocks = None
+		yield (RESULT, None)
 
 	def write(self, indent=0):
 		"""
@@ -27,6 +27,27 @@ Tokenize text and build a token tree based on matching parentheses.
 
 from text import TextError, TextRange, where_from_pos
 
+# Number of bits in the token summaries of Groups
+SUMMARY_BITS = 512
+
+def token_bit(text):
+	"""
+	Return the bit that stands for tokens with the given text in summaries.
+
+	The bit only depends on the hash of the text, so distinct texts may share a bit.
+	"""
+	return 1 << (hash(text) % SUMMARY_BITS)
+
+class Group(list):
+	"""
+	List of the tokens and sub-lists between matching parentheses, as built by Treeify.
+
+	summary has the token_bit of every token in the group (including all sub-lists) set,
+	so that matching can skip groups that lack a token it needs. depth is the number of
+	levels of sub-lists nested inside the group (0 if it has none).
+	"""
+	__slots__ = [ "summary", "depth" ]
+
 def tok_whitespace(white):
 	"""
 	Generate a function for use in Tokenizer.addfn that will discard all characters in white.
@@ -134,7 +155,9 @@ class Treeify(object):
 		self.parens.append((open, close))
 
 	def maketree(self, tokens, close=None):
-		liststack = [[]]
+		liststack = [Group()]
+		summarystack = [0]
+		depthstack = [0]
 		closestack = [close]
 
 		for tok in tokens:
@@ -143,7 +166,10 @@ class Treeify(object):
 			for open,close in self.parens:
 				if s == open:
 					liststack[-1].append(tok)
-					liststack.append([])
+					summarystack[-1] |= token_bit(s)
+					liststack.append(Group())
+					summarystack.append(0)
+					depthstack.append(0)
 					closestack.append(close)
 					break
 				elif s == close:
@@ -151,8 +177,15 @@ class Treeify(object):
 						raise TextError(tok.text, tok.start, "unexpected closing '%s'" % (s))
 
 					if len(liststack) == 1:
+						liststack[0].summary = summarystack[0]
+						liststack[0].depth = depthstack[0]
 						return liststack[0]
 
+					liststack[-1].summary = summarystack.pop()
+					summarystack[-1] |= liststack[-1].summary | token_bit(s)
+					liststack[-1].depth = depthstack.pop()
+					if depthstack[-1] <= liststack[-1].depth:
+						depthstack[-1] = liststack[-1].depth + 1
 					liststack[-2].append(liststack[-1])
 					liststack.pop()
 					liststack[-1].append(tok)
@@ -160,9 +193,12 @@ class Treeify(object):
 					break
 			else:
 				liststack[-1].append(tok)
+				summarystack[-1] |= token_bit(s)
 
 		if len(liststack) > 1:
 			open = liststack[-2][-1]
 			raise TextError(open.text, open.start, "unclosed '%s'" % (str(open)))
 
+		liststack[0].summary = summarystack[0]
+		liststack[0].depth = depthstack[0]
 		return liststack[0]
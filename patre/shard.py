@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011 Nicolai Hähnle <nhaehnle@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+
+"""
+Split the input files of a run into shards that can be processed independently,
+e.g. on several machines, and merge the reports written by the shards.
+"""
+
+import json
+import os
+import zlib
+
+def parse(spec):
+	"""
+	Parse a shard specification of the form K/N, where 1 <= K <= N.
+	Returns the pair (K, N), or raises ValueError.
+	"""
+	try:
+		index, count = [int(part) for part in spec.split('/')]
+	except ValueError:
+		raise ValueError("invalid shard '%s', expected K/N" % (spec))
+	if count < 1 or not 1 <= index <= count:
+		raise ValueError("invalid shard '%s', K must be between 1 and N" % (spec))
+	return index, count
+
+def path_hash(path):
+	"""
+	Hash of a path that does not depend on the Python version or the machine.
+	"""
+	return zlib.crc32(os.path.normpath(path)) & 0xffffffff
+
+def partition(paths, count, weighted=False):
+	"""
+	Partition the given paths into count lists.
+
+	By default, every path is assigned by its hash. If weighted is set, paths are assigned
+	greedily in order of decreasing file size to the shard with the least total size.
+	In both cases, the result only depends on the set of paths (and their sizes).
+	"""
+	shards = [[] for i in xrange(count)]
+	if not weighted:
+		for path in paths:
+			shards[path_hash(path) % count].append(path)
+	else:
+		def size(path):
+			try:
+				return os.path.getsize(path)
+			except OSError:
+				return 0
+
+		loads = [0] * count
+		for weight, hashed, path in sorted([(-size(path), path_hash(path), path) for path in paths]):
+			idx = min(xrange(count), key=lambda idx: (loads[idx], idx))
+			shards[idx].append(path)
+			loads[idx] -= weight
+	for shard in shards:
+		shard.sort()
+	return shards
+
+def select(paths, spec, weighted=False):
+	"""
+	Return the paths that belong to the shard given as K/N.
+	"""
+	index, count = parse(spec)
+	return partition(paths, count, weighted)[index - 1]
+
+def encode(text):
+	# File contents are arbitrary bytes; latin-1 maps them to unicode and back without loss
+	return text.decode('latin-1')
+
+def decode(text):
+	return text.encode('latin-1')
+
+class Report(object):
+	"""
+	Results of one shard: the diff of every changed file, files that were skipped or
+	failed, and some statistics.
+	"""
+	def __init__(self, shard=None):
+		self.shards = [shard] if shard != None else []
+		self.files = 0
+		self.seconds = 0.0
+		self.diffs = {}
+		self.skipped = {}
+		self.errors = {}
+
+	def add(self, fname, diff):
+		self.files += 1
+		if diff:
+			self.diffs[fname] = diff
+
+	def skip(self, fname, reason):
+		self.files += 1
+		self.skipped[fname] = reason
+
+	def error(self, fname, reason):
+		self.files += 1
+		self.errors[fname] = reason
+
+	def merge(self, other):
+		self.shards += other.shards
+		self.files += other.files
+		self.seconds += other.seconds
+		for mine, theirs in [(self.diffs, other.diffs), (self.skipped, other.skipped), (self.errors, other.errors)]:
+			for fname in theirs:
+				if fname in self.diffs or fname in self.skipped or fname in self.errors:
+					raise ValueError("%s was processed by more than one shard" % (fname))
+				mine[fname] = theirs[fname]
+
+	def missing_shards(self):
+		"""
+		Return the shards K/N that are expected, given the shards merged so far, but missing.
+		"""
+		counts = set([parse(shard)[1] for shard in self.shards])
+		if len(counts) > 1:
+			raise ValueError("cannot merge shards of different partitions: %s" % (", ".join(self.shards)))
+		if len(set(self.shards)) < len(self.shards):
+			raise ValueError("some shards were given more than once")
+		return [
+			"%d/%d" % (index, count) for count in counts for index in xrange(1, count + 1)
+			if not "%d/%d" % (index, count) in self.shards
+		]
+
+	def patch(self):
+		return ''.join(self.diffs[fname] for fname in sorted(self.diffs))
+
+	def summary(self):
+		return "%d files processed, %d changed, %d skipped, %d errors in %.1f seconds" % (
+			self.files, len(self.diffs), len(self.skipped), len(self.errors), self.seconds
+		)
+
+	def save(self, fname):
+		data = {
+			"shards": self.shards,
+			"files": self.files,
+			"seconds": self.seconds,
+			"diffs": dict((encode(name), encode(diff)) for name, diff in self.diffs.items()),
+			"skipped": dict((encode(name), encode(reason)) for name, reason in self.skipped.items()),
+			"errors": dict((encode(name), encode(reason)) for name, reason in self.errors.items()),
+		}
+		tmpname = fname + ".tmp"
+		with open(tmpname, 'w') as filp:
+			json.dump(data, filp, indent=1, sort_keys=True)
+		os.rename(tmpname, fname)
+
+	@staticmethod
+	def load(fname):
+		with open(fname, 'r') as filp:
+			try:
+				data = json.load(filp)
+			except ValueError as e:
+				raise ValueError("%s: not a patrex report: %s" % (fname, e))
+		report = Report()
+		report.shards = [str(shard) for shard in data["shards"]]
+		report.files = data["files"]
+		report.seconds = data["seconds"]
+		report.diffs = dict((decode(name), decode(diff)) for name, diff in data["diffs"].items())
+		report.skipped = dict((decode(name), decode(reason)) for name, reason in data["skipped"].items())
+		report.errors = dict((decode(name), decode(reason)) for name, reason in data["errors"].items())
+		return report
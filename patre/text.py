@@ -86,11 +86,17 @@ class Editor(object):
 	def erase(self, start, end):
 		self.erases.append((start, end))
 
-	def apply(self, text):
+	def changes(self):
+		"""
+		Return the effect of all operations as a sorted list of non-overlapping
+		(start, end, replacement) triples.
+
+		Erases that overlap an earlier erase and inserts inside an erased range are dropped.
+		"""
 		self.inserts.sort(key=lambda x: x[0])
 		self.erases.sort(key=lambda x: x[0])
 
-		gen = []
+		changes = []
 		idxinsert = 0
 		idxerase = 0
 		where = 0
@@ -108,20 +114,32 @@ class Editor(object):
 				nextinsert = self.inserts[idxinsert][0]
 
 			if nextinsert == None and nexterase == None:
-				gen.append(text[where:])
 				break
 
 			if nexterase != None and (nextinsert == None or nexterase < nextinsert):
-				gen.append(text[where:nexterase])
-				where = self.erases[idxerase][1]
+				start, where = self.erases[idxerase]
+				what = ''
 				idxerase += 1
 			else:
-				ins = self.inserts[idxinsert]
-				gen.append(text[where:ins[0]])
-				where = ins[0]
-				gen.append(ins[1])
+				start, what = self.inserts[idxinsert]
+				where = start
 				idxinsert += 1
 
+			if changes and changes[-1][1] == start:
+				changes[-1] = (changes[-1][0], where, changes[-1][2] + what)
+			elif where != start or what:
+				changes.append((start, where, what))
+
+		return changes
+
+	def apply(self, text):
+		gen = []
+		where = 0
+		for start, end, what in self.changes():
+			gen.append(text[where:start])
+			gen.append(what)
+			where = end
+		gen.append(text[where:])
 		return ''.join(gen)
 
 	def have_changes(self):
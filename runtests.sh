@@ -30,5 +30,180 @@ for patrex in $( ls tests/*.patrex ); do
 	total=$((total+1))
 done
 
+# Command line tests: every function runs in a fresh temporary directory and
+# prints what went wrong, if anything
+patrexcmd=$(pwd)/patrex
+testsdir=$(pwd)/tests
+
+# Applying the output of --diff must give the same files as --inplace
+function cli_diff {
+	for patrex in ${testsdir}/*.patrex; do
+		infile=${patrex/.patrex/.in}
+		mkdir diff inplace
+		cp ${infile} diff/input
+		cp ${infile} inplace/input
+		(cd diff && ${patrexcmd} --diff ${patrex} input > ../patch 2> /dev/null)
+		(cd inplace && ${patrexcmd} --inplace ${patrex} input 2> /dev/null)
+		if [[ -s patch ]]; then
+			(cd diff && git apply --whitespace=nowarn ../patch) || echo "git apply failed for ${patrex}"
+		fi
+		cmp -s diff/input inplace/input || echo "--diff and --inplace differ for ${patrex}"
+		rm -r diff inplace patch
+	done
+}
+
+# Merging the reports of all shards must give the same patch as a single run
+function cli_shard {
+	cp ${testsdir}/*.in .
+	for patrex in ${testsdir}/*.patrex; do
+		${patrexcmd} --diff ${patrex} *.in > single 2> /dev/null
+		for by in "" "--shard-by-size"; do
+			for k in 1 2 3; do
+				${patrexcmd} --shard ${k}/3 ${by} --report shard${k}.json ${patrex} *.in > /dev/null 2>&1
+			done
+			${patrexcmd} merge shard*.json > merged 2> /dev/null
+			cmp -s single merged || echo "merged shards ${by} differ from a single run for ${patrex}"
+			rm shard*.json merged
+		done
+		rm single
+	done
+}
+
+# --since-last only processes the files changed since the last --inplace run
+function cli_since {
+	patrex=${testsdir}/test01.patrex
+	mkdir repo
+	cd repo
+	git init -q .
+	git config user.name patrex
+	git config user.email patrex@localhost
+	cp ${testsdir}/test01.in a.in
+	cp ${testsdir}/test01.in b.in
+	git add a.in b.in
+	git commit -q -m initial
+
+	if ${patrexcmd} --since-last ${patrex} > /dev/null 2>&1; then
+		echo "--since-last without paths did not fail"
+	fi
+
+	${patrexcmd} --inplace --since-last ${patrex} . 2> /dev/null
+	cmp -s a.in ${testsdir}/test01.out || echo "first run did not process a.in"
+	cmp -s b.in ${testsdir}/test01.out || echo "first run did not process b.in"
+	git commit -q -a -m processed
+	${patrexcmd} --inplace --since-last ${patrex} . 2> /dev/null
+	state=$(cat .git/patrex-state)
+	[[ ${state} == "$(git rev-parse HEAD) ${patrex}" ]] || echo "the state does not record the last revision"
+
+	cp ${testsdir}/test01.in b.in
+	cp ${testsdir}/test01.in c.in
+	${patrexcmd} --diff --since-last ${patrex} . > ../patch 2> /dev/null
+	if [[ $(grep '^+++ ' ../patch) != $'+++ b/b.in\n+++ b/c.in' ]]; then
+		echo "--since-last did not select exactly the changed and untracked files:"
+		grep '^+++ ' ../patch
+	fi
+	${patrexcmd} --since-last ${patrex} . > /dev/null 2>&1
+	[[ $(cat .git/patrex-state) == ${state} ]] || echo "a run without --inplace recorded its revision"
+
+	git add b.in c.in
+	git commit -q -m changed
+	${patrexcmd} --inplace --since-last ${patrex} . 2> /dev/null
+	cmp -s b.in ${testsdir}/test01.out || echo "last run did not process b.in"
+	cmp -s c.in ${testsdir}/test01.out || echo "last run did not process c.in"
+	[[ $(cat .git/patrex-state) != ${state} ]] || echo "an --inplace run did not record its revision"
+	state=$(cat .git/patrex-state)
+
+	# Files that cannot be processed keep the revision from being recorded, unless --include
+	# leaves them out
+	echo "see (1" > NOTES.txt
+	cp ${testsdir}/test01.in d.in
+	git add d.in
+	git commit -q -m added
+	if ${patrexcmd} --inplace --since-last ${patrex} . 2> ../stderr; then
+		echo "a run that could not process a file and did not record its revision did not fail"
+	fi
+	grep -q "^Warning: not recording the revision" ../stderr || echo "no warning about the revision that was not recorded"
+	[[ $(cat .git/patrex-state) == ${state} ]] || echo "a run with errors recorded its revision"
+	cp ${testsdir}/test01.in d.in
+	${patrexcmd} --inplace --since-last --include '*.in' ${patrex} . 2> /dev/null || echo "a run with --include failed"
+	cmp -s d.in ${testsdir}/test01.out || echo "a run with --include did not process d.in"
+	cmp -s NOTES.txt <(echo "see (1") || echo "a run with --include processed NOTES.txt"
+	[[ $(cat .git/patrex-state) != ${state} ]] || echo "a run with --include did not record its revision"
+}
+
+# Files that exceed the budget are skipped with a message naming the rule,
+# while the other files are still processed
+function cli_budget {
+	patrex=${testsdir}/test01.patrex
+	mkdir repo
+	cd repo
+	git init -q .
+	git config user.name patrex
+	git config user.email patrex@localhost
+	cp ${testsdir}/test01.in a.in
+	for i in $(seq 50); do
+		cat ${testsdir}/test01.in
+	done > b.in
+	cp b.in ../b.in
+	git add a.in b.in
+	git commit -q -m initial
+
+	if ${patrexcmd} --inplace --since-last --max-steps 1000 ${patrex} . 2> ../stderr; then
+		echo "a run that skipped a file did not fail"
+	fi
+	if [[ $(head -n 1 ../stderr) != "Skipping b.in: more than 1000 NFA steps (rule at line 2)" ]]; then
+		echo "unexpected message for a file that exceeds --max-steps:"
+		cat ../stderr
+	fi
+	cmp -s a.in ${testsdir}/test01.out || echo "a.in was not processed"
+	cmp -s b.in ../b.in || echo "b.in was changed although it was skipped"
+	[[ ! -e .git/patrex-state ]] || echo "a run that skipped a file recorded its revision"
+
+	if ${patrexcmd} --max-states 3 ${patrex} ${testsdir}/test01.in > /dev/null 2> ../stderr; then
+		echo "a run that skipped a file did not fail"
+	fi
+	if [[ $(cat ../stderr) != "Skipping ${testsdir}/test01.in: more than 3 active NFA states (rule at line 2)" ]]; then
+		echo "unexpected message for a file that exceeds --max-states:"
+		cat ../stderr
+	fi
+
+	# Merged reports fail like a single run: for skipped files, but not for errors
+	${patrexcmd} --shard 1/1 --report ../shard.json --max-steps 1000 ${patrex} a.in b.in > /dev/null 2>&1
+	if ${patrexcmd} merge ../shard.json > /dev/null 2>&1; then
+		echo "merging a report with skipped files did not fail"
+	fi
+	${patrexcmd} --shard 1/1 --report ../shard.json ${patrex} a.in missing.in > /dev/null 2>&1
+	${patrexcmd} merge ../shard.json > /dev/null 2>&1 || echo "merging a report with errors failed"
+}
+
+for cli in cli_diff cli_shard cli_since cli_budget; do
+	tmpdir=$(mktemp -d)
+	report=$(cd ${tmpdir} && ${cli} 2>&1)
+	rm -rf ${tmpdir}
+	if [[ $report == "" ]]; then
+		success=$((success+1))
+	else
+		echo "-------------------------"
+		echo "FAILURE: ${cli}"
+		echo "${report}"
+	fi
+	total=$((total+1))
+done
+
+# The bulk tokenizer is only used with NumPy, and must agree with the character-based one
+if python -c "import numpy" 2> /dev/null; then
+	report=$(python tests/check_tokenizer.py tests/*.in 2>&1)
+	if [[ $report == "" ]]; then
+		success=$((success+1))
+	else
+		echo "-------------------------"
+		echo "FAILURE: tests/check_tokenizer.py"
+		echo "${report}"
+	fi
+	total=$((total+1))
+else
+	echo "-------------------------"
+	echo "SKIPPED: tests/check_tokenizer.py (NumPy is not available)"
+fi
+
 echo "-------------------------------------------"
 echo "${success} OUT OF ${total} TEST SUCCESSFUL."
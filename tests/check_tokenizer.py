@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011 Nicolai Hähnle <nhaehnle@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Check that patre.bulk.tokenizer produces the same tokens and errors as patre.cpp.tokenizer
+on the given files, on every prefix of them that ends just after a comment or literal
+delimiter (which covers unterminated comments and literals), and on some corner cases.
+
+Prints the inputs on which they differ.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import patre.bulk
+import patre.cpp
+
+CASES = [
+	"",
+	" \t\n",
+	"a /* b",
+	"a /* b */ c /*",
+	"a // b",
+	"a // b\nc",
+	"a/b/*/c*/d",
+	"x = \"abc",
+	"x = 'a",
+	"\"a\\\"",
+	"\"a\\\\\" b",
+	"'\\\\\\'' c",
+	"\"/* not a comment */\" d",
+	"/* \"not a literal\" */ e",
+	"// \"not a literal\"\nf",
+	"9a b9 _9 a_b",
+]
+
+def tokens(tokenizer, text):
+	"""
+	Return the (start, end, tag) of all tokens up to the first error, and the error message, if any.
+	"""
+	result = []
+	try:
+		for token in tokenizer(text)():
+			result.append((token.start, token.end, token.tag))
+	except ValueError as e:
+		return result, str(e)
+	return result, None
+
+def prefixes(text):
+	yield text
+	for pos in range(len(text)):
+		if text[pos] in "\"'" or text.startswith("/*", pos):
+			yield text[:pos + 1]
+
+def main():
+	if patre.bulk.numpy == None:
+		print "NumPy is not available"
+		sys.exit(1)
+
+	texts = list(CASES)
+	for fname in sys.argv[1:]:
+		with open(fname, 'r') as filp:
+			texts.extend(prefixes(filp.read()))
+
+	failed = False
+	for text in texts:
+		expected = tokens(patre.cpp.tokenizer, text)
+		actual = tokens(patre.bulk.tokenizer, text)
+		if actual != expected:
+			print "tokenizers differ on %r:" % (text[-60:])
+			print "  patre.cpp: %s tokens, error %s" % (len(expected[0]), expected[1])
+			print "  patre.bulk: %s tokens, error %s" % (len(actual[0]), actual[1])
+			failed = True
+	if failed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()